@@ -1,15 +1,25 @@
 import runpod
 import logging
-import base64
 import os
 import subprocess
+import shutil
+import hashlib
 import time
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Set, Tuple
 import threading
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from utils.workflow import process_image_to_video
+from cachetools import TTLCache
+
+try:
+    import pybase64 as base64  # SIMD base64, same API as the stdlib module
+except ImportError:
+    import base64
+
+from utils.workflow import ComfyUIWorkflow, process_image_to_video
 from utils.model_manager import check_and_download_models
 
 # Configure logging
@@ -25,6 +35,81 @@ logger = logging.getLogger(__name__)
 # Global ComfyUI process
 comfy_process = None
 
+# ComfyUI log lines printed once the HTTP server is listening
+COMFYUI_READY_MARKERS = ("To see the GUI go to", "Starting server")
+COMFYUI_START_TIMEOUT = 60
+
+# Last ComfyUI output lines, reported if it fails to start
+comfy_output = deque(maxlen=50)
+
+# Largest accepted input image (decoded) and its base64 length
+MAX_IMAGE_BYTES = 50 * 1024 * 1024
+MAX_B64_LEN = 4 * ((MAX_IMAGE_BYTES + 2) // 3)
+
+# Size of each head/middle/tail sample checked during validation
+B64_SAMPLE_LEN = 4096
+
+# Accepted request parameters
+CAMERA_TYPES = ("Zoom In", "Static", "Zoom Out", "Pan Left", "Pan Right")
+VALID_CAMERA_TYPES = frozenset(CAMERA_TYPES)
+DIMENSION_RANGE = (256, 1920)
+LENGTH_RANGE = (16, 200)  # frames
+SPEED_RANGE = (0.1, 1.0)
+
+# Recent results by input hash, so retried or duplicated jobs skip generation
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 300))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+result_cache = TTLCache(
+    maxsize=RESULT_CACHE_MAX_BYTES,
+    ttl=RESULT_CACHE_TTL,
+    getsizeof=lambda result: len(result[0])
+)
+result_cache_lock = threading.Lock()
+inflight_locks: Dict[str, threading.Lock] = {}
+
+# Videos go to the S3-compatible bucket from RunPod's BUCKET_* env vars when configured
+BUCKET_ENABLED = bool(os.environ.get('BUCKET_ENDPOINT_URL'))
+BUCKET_NAME = os.environ.get('BUCKET_NAME')
+
+def numa_node_count() -> int:
+    """Number of NUMA nodes on this host"""
+    return len(list(Path("/sys/devices/system/node").glob("node[0-9]*")))
+
+def parse_cpulist(cpulist: str) -> Set[int]:
+    """CPU ids of a kernel cpulist, e.g. 0-15,32-47"""
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+def usable_cpus(numa_node: Optional[str] = None) -> int:
+    """CPUs this container may run on, only those of numa_node when pinned to one"""
+    cpus = os.sched_getaffinity(0)
+    if numa_node is not None:
+        try:
+            node_cpus = Path(f"/sys/devices/system/node/node{numa_node}/cpulist").read_text()
+            cpus = cpus & parse_cpulist(node_cpus)
+        except (OSError, ValueError):
+            pass
+    return max(1, len(cpus))
+
+def stream_comfyui_output(process: subprocess.Popen, ready: threading.Event):
+    """Forward ComfyUI output to the log and flag when the server is up"""
+    comfy_logger = logging.getLogger("comfyui")
+    for line in iter(process.stdout.readline, ''):
+        line = line.rstrip()
+        comfy_output.append(line)
+        comfy_logger.info(line)
+        if not ready.is_set() and any(marker in line for marker in COMFYUI_READY_MARKERS):
+            ready.set()
+    
+    # Output closed, reap the process so poll() sees the exit before waking the waiter
+    process.wait()
+    ready.set()
+
 def start_comfyui_server():
     """Start ComfyUI server in background"""
     global comfy_process
@@ -55,6 +140,19 @@ def start_comfyui_server():
         env = os.environ.copy()
         env['CUDA_VISIBLE_DEVICES'] = '0'
         
+        # Keep CPU and memory on one node on multi-socket hosts
+        numa_node = None
+        if numa_node_count() > 1 and shutil.which("numactl"):
+            numa_node = os.environ.get('COMFYUI_NUMA_NODE', '0')
+            cmd = ["numactl", f"--cpunodebind={numa_node}", f"--membind={numa_node}"] + cmd
+            logger.info(f"Pinning ComfyUI to NUMA node {numa_node}")
+        
+        # Fewer malloc arenas for a long-running PyTorch process, lazy CUDA kernel loading
+        # One OpenMP thread per CPU we can actually run on (cpuset and NUMA binding)
+        env.setdefault('MALLOC_ARENA_MAX', '2')
+        env.setdefault('OMP_NUM_THREADS', str(usable_cpus(numa_node)))
+        env.setdefault('CUDA_MODULE_LOADING', 'LAZY')
+        
         comfy_process = subprocess.Popen(
             cmd,
             cwd=comfy_dir,
@@ -64,18 +162,24 @@ def start_comfyui_server():
             env=env
         )
         
-        # Wait a bit for server to start
-        time.sleep(15)
+        # Drain stdout (a full pipe would block ComfyUI) and watch for the startup banner
+        ready = threading.Event()
+        comfy_output.clear()
+        threading.Thread(
+            target=stream_comfyui_output,
+            args=(comfy_process, ready),
+            name="comfyui-output",
+            daemon=True
+        ).start()
+        
+        if not ready.wait(timeout=COMFYUI_START_TIMEOUT):
+            logger.warning(f"No ComfyUI startup banner after {COMFYUI_START_TIMEOUT}s, continuing")
         
         # Check if process is still running
         if comfy_process.poll() is not None:
-            # Read any error output
-            try:
-                stdout, stderr = comfy_process.communicate(timeout=5)
-                logger.error(f"ComfyUI failed to start. Output: {stdout}")
-            except:
-                pass
-            raise Exception("ComfyUI failed to start")
+            output = "\n".join(comfy_output)
+            logger.error(f"ComfyUI failed to start. Output: {output}")
+            raise Exception(f"ComfyUI failed to start (exit code {comfy_process.returncode})")
         
         logger.info("ComfyUI server started successfully")
         
@@ -83,26 +187,56 @@ def start_comfyui_server():
         logger.error(f"Failed to start ComfyUI: {e}")
         raise
 
-def wait_for_comfyui():
+def readiness_delay(attempt: int) -> float:
+    """Poll densely at first, the server comes up all at once"""
+    if attempt < 10:
+        return 0.25
+    if attempt < 30:
+        return 1.0
+    return 2.0
+
+def wait_for_comfyui(max_wait: int = 120):
     """Wait for ComfyUI to be ready"""
     import requests
     
-    max_retries = 60  # Increased timeout
-    for i in range(max_retries):
+    start_time = time.time()
+    attempt = 0
+    while time.time() - start_time < max_wait:
         try:
-            response = requests.get("http://127.0.0.1:8188", timeout=10)
-            if response.status_code == 200:
+            # Small JSON endpoint instead of the frontend HTML
+            response = requests.get("http://127.0.0.1:8188/system_stats", timeout=1)
+            if response.status_code == 200 and 'system' in response.json():
                 logger.info("✓ ComfyUI is ready")
                 return True
         except Exception as e:
-            if i == 0:
+            if attempt == 0:
                 logger.info("Waiting for ComfyUI to start...")
-            elif i % 10 == 0:  # Log every 20 seconds
-                logger.info(f"Still waiting for ComfyUI... ({i+1}/{max_retries})")
+            elif attempt % 10 == 0:
+                logger.info(f"Still waiting for ComfyUI... ({time.time() - start_time:.0f}s)")
         
-        time.sleep(2)
+        time.sleep(readiness_delay(attempt))
+        attempt += 1
     
-    raise Exception(f"ComfyUI failed to become ready after {max_retries * 2} seconds")
+    raise Exception(f"ComfyUI failed to become ready after {max_wait} seconds")
+
+def check_base64_sampled(image_data: str) -> None:
+    """Cheap structural base64 check on head, middle and tail samples"""
+    if len(image_data) % 4 != 0:
+        raise ValueError("Invalid base64 length")
+    
+    if len(image_data) <= 3 * B64_SAMPLE_LEN:
+        base64.b64decode(image_data, validate=True)
+        return
+    
+    # 4-aligned offsets so every sample decodes on its own
+    mid = (len(image_data) // 2) // 4 * 4
+    samples = (
+        image_data[:B64_SAMPLE_LEN],
+        image_data[mid:mid + B64_SAMPLE_LEN],
+        image_data[-B64_SAMPLE_LEN:],
+    )
+    for sample in samples:
+        base64.b64decode(sample, validate=True)
 
 def validate_input(job_input: Dict[str, Any]) -> Dict[str, Any]:
     """Validate and normalize input parameters"""
@@ -119,7 +253,16 @@ def validate_input(job_input: Dict[str, Any]) -> Dict[str, Any]:
             # Check if it has data URL prefix and remove it
             if image_data.startswith('data:image/'):
                 image_data = image_data.split(',', 1)[1]
-            base64.b64decode(image_data)
+            image_data = image_data.strip()
+        except Exception:
+            raise ValueError("Invalid base64 image data")
+        
+        if len(image_data) > MAX_B64_LEN:
+            raise ValueError(f"Image too large (max {MAX_IMAGE_BYTES // (1024*1024)} MB)")
+        
+        # Full decode happens once, in process_image_to_video
+        try:
+            check_base64_sampled(image_data)
         except Exception:
             raise ValueError("Invalid base64 image data")
     else:
@@ -138,24 +281,77 @@ def validate_input(job_input: Dict[str, Any]) -> Dict[str, Any]:
     }
     
     # Validate camera type
-    valid_camera_types = ["Zoom In", "Static", "Zoom Out", "Pan Left", "Pan Right"]
-    if validated["camera_type"] not in valid_camera_types:
-        raise ValueError(f"Invalid camera_type. Must be one of: {valid_camera_types}")
+    if validated["camera_type"] not in VALID_CAMERA_TYPES:
+        raise ValueError(f"Invalid camera_type. Must be one of: {list(CAMERA_TYPES)}")
     
     # Validate dimensions
-    if not (256 <= validated["width"] <= 1920 and 256 <= validated["height"] <= 1920):
-        raise ValueError("Width and height must be between 256 and 1920")
+    min_dim, max_dim = DIMENSION_RANGE
+    if not (min_dim <= validated["width"] <= max_dim and min_dim <= validated["height"] <= max_dim):
+        raise ValueError(f"Width and height must be between {min_dim} and {max_dim}")
     
     # Validate length
-    if not (16 <= validated["length"] <= 200):
-        raise ValueError("Length must be between 16 and 200 frames")
+    min_length, max_length = LENGTH_RANGE
+    if not (min_length <= validated["length"] <= max_length):
+        raise ValueError(f"Length must be between {min_length} and {max_length} frames")
         
     # Validate speed
-    if not (0.1 <= validated["speed"] <= 1.0):
-        raise ValueError("Speed must be between 0.1 and 1.0")
+    min_speed, max_speed = SPEED_RANGE
+    if not (min_speed <= validated["speed"] <= max_speed):
+        raise ValueError(f"Speed must be between {min_speed} and {max_speed}")
     
     return validated
 
+def job_key(image_data: str, params: Dict[str, Any]) -> str:
+    """Hash of everything that determines the generated video"""
+    digest = hashlib.blake2b(image_data.encode('ascii'), digest_size=16)
+    digest.update(repr(sorted(params.items())).encode('utf-8'))
+    return digest.hexdigest()
+
+def generate_video(image_data: str, params: Dict[str, Any]) -> Tuple[bytes, str, bool]:
+    """Run the workflow, or reuse a recent result for identical input"""
+    key = job_key(image_data, params)
+    
+    with result_cache_lock:
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached[0], cached[1], True
+        key_lock = inflight_locks.setdefault(key, threading.Lock())
+    
+    # Identical jobs in flight wait for the first one instead of generating again
+    with key_lock:
+        with result_cache_lock:
+            cached = result_cache.get(key)
+        if cached is not None:
+            return cached[0], cached[1], True
+        
+        try:
+            video_data, filename = process_image_to_video(image_data, **params)
+            with result_cache_lock:
+                try:
+                    result_cache[key] = (video_data, filename)
+                except ValueError:
+                    pass  # Larger than the whole cache
+        finally:
+            with result_cache_lock:
+                inflight_locks.pop(key, None)
+    
+    return video_data, filename, False
+
+def upload_video(video_data: bytes, filename: str, job_id: str) -> Optional[str]:
+    """Upload the video to the job bucket and return a presigned URL, None on failure"""
+    # Imported here, it pulls in boto3 which only bucket deployments need
+    from runpod.serverless.utils import rp_upload
+    
+    try:
+        video_url = rp_upload.upload_in_memory_object(
+            filename, video_data, bucket_name=BUCKET_NAME, prefix=job_id
+        )
+        logger.info("✓ Video uploaded to bucket")
+        return video_url
+    except Exception as e:
+        logger.warning(f"Bucket upload failed, returning video inline: {e}")
+        return None
+
 def handler(job):
     """Main RunPod handler function"""
     job_input = job["input"]
@@ -170,25 +366,36 @@ def handler(job):
         logger.info("✓ Input validation passed")
         
         # Process image to video
+        image_data = validated_input.pop("image")
         start_time = time.time()
-        video_data, filename = process_image_to_video(**validated_input)
+        video_data, filename, cached = generate_video(image_data, validated_input)
         processing_time = time.time() - start_time
         
-        # Encode video as base64 for response
-        video_b64 = base64.b64encode(video_data).decode('utf-8')
-        
+        if cached:
+            logger.info("✓ Reused cached result for identical input")
         logger.info(f"✓ Video generation completed in {processing_time:.1f}s")
         logger.info(f"✓ Output filename: {filename}")
         logger.info(f"✓ Video size: {len(video_data) / (1024*1024):.1f} MB")
         
-        return {
-            "video": video_b64,
+        response = {
             "filename": filename,
             "processing_time": processing_time,
             "parameters_used": validated_input,
+            "cached": cached,
             "success": True
         }
         
+        # Return a presigned URL instead of inflating the video into the JSON body
+        if BUCKET_ENABLED and not job_input.get("return_inline"):
+            video_url = upload_video(video_data, filename, job_id)
+            if video_url:
+                response["video_url"] = video_url
+                return response
+        
+        # Encode video as base64 for response
+        response["video"] = base64.b64encode(video_data).decode('ascii')
+        return response
+        
     except Exception as e:
         logger.error(f"❌ Handler error: {str(e)}", exc_info=True)
         return {"error": str(e), "success": False}
@@ -204,17 +411,32 @@ def initialize():
     
     logger.info(f"✓ Volume mounted at: {volume_path}")
     
-    # Download models if needed
-    logger.info("📦 Checking models...")
-    check_and_download_models()
-    logger.info("✓ Models ready")
-    
-    # Start ComfyUI server
-    start_comfyui_server()
+    # Boot ComfyUI while models download, weights are only loaded at first inference
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="comfyui-start") as executor:
+        comfy_start = executor.submit(start_comfyui_server)
+        
+        # Download models if needed
+        logger.info("📦 Checking models...")
+        check_and_download_models()
+        logger.info("✓ Models ready")
+        
+        # Raises if the server failed to start
+        comfy_start.result()
     
     # Wait for ComfyUI to be ready
     wait_for_comfyui()
     
+    # Load the models now instead of on the first request
+    if os.environ.get('COMFYUI_WARMUP', '1') == '1':
+        logger.info("🔥 Warming up ComfyUI...")
+        try:
+            with ComfyUIWorkflow() as comfy:
+                comfy.warmup()
+            logger.info("✓ ComfyUI warm")
+        except Exception as e:
+            # The first request pays the load instead
+            logger.warning(f"Warmup failed: {e}")
+    
     logger.info("🎉 Initialization complete - Ready for requests!")
 
 if __name__ == "__main__":
@@ -25,10 +25,7 @@ cd /app/ComfyUI
 rm -rf models
 ln -sf $RUNPOD_VOLUME_PATH/models models
 
-# Initialize model manager to download missing models
-echo "Checking and downloading models..."
-python3 /app/utils/model_manager.py
-
+# Missing models are downloaded by the handler while ComfyUI boots
 echo "Model setup complete. Starting handler..."
 
 # Start the RunPod handler
@@ -0,0 +1,348 @@
+import asyncio
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, AsyncIterator, Optional, Tuple, Union
+
+import aiohttp
+
+from utils.workflow import (
+    POLL_MAX_DELAY,
+    COMFY_INPUT_DIR,
+    MAX_CONCURRENT_JOBS,
+    decode_image,
+    encode_prompt,
+    encode_wan_workflow,
+    find_video_output,
+    json_loads,
+    poll_delay,
+    prompt_in_queue,
+    temp_image_filename,
+    write_input_image,
+)
+
+logger = logging.getLogger(__name__)
+
+# MAX_CONCURRENT_JOBS for the async path, enforced separately from the sync path's
+# semaphore, so a process using both can have twice as many prompts in flight
+GPU_SLOTS = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+
+async def stage_input_image(client: "AsyncComfyUIWorkflow", image_bytes: bytes, filename: str):
+    """Upload an image, or write it into the shared ComfyUI input directory"""
+    if COMFY_INPUT_DIR:
+        await asyncio.to_thread(write_input_image, image_bytes, filename)
+    else:
+        await client.upload_image(image_bytes, filename)
+
+class AsyncComfyUIWorkflow:
+    """asyncio ComfyUI client, many prompts can be in flight on one event loop"""
+    
+    # Outcomes kept for prompts that finish before anyone streams them
+    MAX_FINISHED = 256
+    
+    # Per-node and per-step messages passed on to stream_progress
+    PROGRESS_MESSAGES = frozenset(('progress', 'executing', 'executed'))
+    
+    def __init__(self, server_address="127.0.0.1:8188"):
+        self.server_address = server_address
+        self.base_url = f"http://{server_address}"
+        self.client_id = str(uuid.uuid4())
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self.listener: Optional[asyncio.Task] = None
+        self.connect_lock = asyncio.Lock()
+        
+        # Completion futures and progress queues (None once done) of prompts being streamed
+        self.completions: Dict[str, asyncio.Future] = {}
+        self.progress: Dict[str, asyncio.Queue] = {}
+        
+        # Error (None on success) of recently finished prompts
+        self.finished: OrderedDict = OrderedDict()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        """Open the HTTP session and the WebSocket push channel, again if it dropped"""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=32, enable_cleanup_closed=True)
+            self.session = aiohttp.ClientSession(connector=connector)
+        
+        async with self.connect_lock:
+            if self.ws is not None:
+                return
+            try:
+                self.ws = await self.session.ws_connect(
+                    f"ws://{self.server_address}/ws?clientId={self.client_id}",
+                    heartbeat=30
+                )
+                self.listener = asyncio.create_task(self.listen(self.ws))
+            except Exception as e:
+                logger.warning(f"WebSocket unavailable, falling back to polling: {e}")
+
+    async def close(self):
+        """Close the WebSocket and HTTP session"""
+        if self.ws is not None:
+            await self.ws.close()
+            self.ws = None
+        if self.listener is not None:
+            await asyncio.gather(self.listener, return_exceptions=True)
+            self.listener = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def finish(self, prompt_id: str, error: Optional[str] = None):
+        """Record a prompt's outcome, its error or None on success, and wake its stream"""
+        if prompt_id in self.finished:
+            return
+        self.finished[prompt_id] = error
+        if len(self.finished) > self.MAX_FINISHED:
+            self.finished.popitem(last=False)
+        
+        future = self.completions.get(prompt_id)
+        if future is not None and not future.done():
+            future.set_result(error)
+        queue = self.progress.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(None)
+
+    async def listen(self, ws: aiohttp.ClientWebSocketResponse):
+        """Dispatch progress and completion messages to the waiting prompts"""
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue  # Binary preview frames
+                
+                message = json_loads(msg.data)
+                data = message.get('data', {})
+                prompt_id = data.get('prompt_id')
+                if prompt_id is None:
+                    continue
+                
+                message_type = message.get('type')
+                # Sent after the prompt is written to /history, execution_success comes before that
+                if message_type == 'executing' and data.get('node') is None:
+                    self.finish(prompt_id)
+                elif message_type == 'execution_error':
+                    self.finish(prompt_id, str(data.get('exception_message', data)))
+                elif message_type == 'execution_interrupted':
+                    self.finish(prompt_id, "execution interrupted")
+                elif message_type in self.PROGRESS_MESSAGES and prompt_id in self.progress:
+                    self.progress[prompt_id].put_nowait(message)
+        except Exception as e:
+            logger.warning(f"ComfyUI WebSocket closed: {e}")
+            await ws.close()
+        finally:
+            # Socket gone, waiters fall back to polling, the next prompt reconnects
+            if self.ws is ws:
+                self.ws = None
+            for future in self.completions.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("ComfyUI WebSocket closed"))
+            for queue in self.progress.values():
+                queue.put_nowait(None)
+
+    async def queue_prompt(self, workflow: Union[Dict[str, Any], bytes]) -> str:
+        """Queue a prompt (a workflow dict, or its JSON encoding) and return the prompt ID"""
+        # Reconnect before queuing so the new socket sees all of this prompt's messages
+        if self.ws is None:
+            await self.connect()
+        
+        try:
+            data = encode_prompt(workflow, self.client_id)
+            async with self.session.post(f"{self.base_url}/prompt", data=data) as response:
+                response.raise_for_status()
+                result = json_loads(await response.read())
+            return result['prompt_id']
+        except Exception as e:
+            logger.error(f"Failed to queue prompt: {e}")
+            raise
+
+    async def upload_image(self, image_data: bytes, filename: str) -> bool:
+        """Upload image to ComfyUI input directory"""
+        try:
+            form = aiohttp.FormData()
+            form.add_field('image', image_data, filename=filename, content_type='image/png')
+            async with self.session.post(f"{self.base_url}/upload/image", data=form) as response:
+                response.raise_for_status()
+            return True
+        except Exception as e:
+            logger.error(f"Failed to upload image: {e}")
+            raise
+
+    async def get_image(self, filename: str, subfolder: str = "", folder_type: str = "output") -> bytes:
+        """Get generated image from ComfyUI"""
+        try:
+            params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+            async with self.session.get(f"{self.base_url}/view", params=params) as response:
+                response.raise_for_status()
+                return await response.read()
+        except Exception as e:
+            logger.error(f"Failed to get image: {e}")
+            raise
+
+    async def get_history(self, prompt_id: str) -> Dict[str, Any]:
+        """Get execution history for a prompt"""
+        try:
+            async with self.session.get(f"{self.base_url}/history/{prompt_id}") as response:
+                response.raise_for_status()
+                return json_loads(await response.read())
+        except Exception as e:
+            logger.error(f"Failed to get history: {e}")
+            raise
+
+    async def get_queue(self) -> Dict[str, Any]:
+        """Get the running and pending prompts"""
+        try:
+            async with self.session.get(f"{self.base_url}/queue") as response:
+                response.raise_for_status()
+                return json_loads(await response.read())
+        except Exception as e:
+            logger.error(f"Failed to get queue: {e}")
+            raise
+
+    async def stream_progress(self, prompt_id: str, timeout: int = 600) -> AsyncIterator[Dict[str, Any]]:
+        """Yield the prompt's progress, executing and executed messages as they arrive
+        
+        The last item is {"type": "result", "data": <history entry>}. Without a
+        WebSocket only that item is yielded, once polling sees the prompt finish.
+        """
+        start_time = time.time()
+        
+        if self.ws is not None or prompt_id in self.finished:
+            try:
+                if prompt_id in self.finished:
+                    # Done before we started listening
+                    error = self.finished[prompt_id]
+                else:
+                    completion = self.completions[prompt_id] = asyncio.get_running_loop().create_future()
+                    queue = self.progress[prompt_id] = asyncio.Queue()
+                    while True:
+                        remaining = max(0, timeout - (time.time() - start_time))
+                        try:
+                            message = await asyncio.wait_for(queue.get(), remaining)
+                        except asyncio.TimeoutError:
+                            raise TimeoutError(f"Workflow execution timed out after {timeout} seconds")
+                        if message is None:
+                            break
+                        yield message
+                    
+                    # Raises ConnectionError if the socket closed first
+                    error = completion.result()
+            except ConnectionError as e:
+                logger.warning(f"{e}, falling back to polling")
+            else:
+                if error is not None:
+                    raise Exception(f"ComfyUI execution failed: {error}")
+                history = await self.get_history(prompt_id)
+                if prompt_id in history:
+                    yield {"type": "result", "data": self.check_result(history[prompt_id])}
+                    return
+            finally:
+                self.completions.pop(prompt_id, None)
+                self.progress.pop(prompt_id, None)
+        
+        result = await self.poll_for_completion(prompt_id, start_time, timeout)
+        yield {"type": "result", "data": result}
+
+    async def wait_for_completion(self, prompt_id: str, timeout: int = 600) -> Dict[str, Any]:
+        """Wait for prompt completion and return results"""
+        async for message in self.stream_progress(prompt_id, timeout):
+            pass
+        return message["data"]
+
+    async def poll_for_completion(self, prompt_id: str, start_time: float, timeout: int) -> Dict[str, Any]:
+        """Poll /queue with a growing delay, /history once the prompt has left it"""
+        attempt = 0
+        
+        while time.time() - start_time < timeout:
+            try:
+                # History is written before the prompt leaves the queue
+                history = {}
+                if not prompt_in_queue(await self.get_queue(), prompt_id):
+                    history = await self.get_history(prompt_id)
+                if prompt_id in history:
+                    result = history[prompt_id]
+                    if 'outputs' in result:
+                        return result
+                    self.check_result(result)
+                
+                await asyncio.sleep(poll_delay(attempt))
+                attempt += 1
+                
+            except aiohttp.ClientError:
+                # ComfyUI might not be fully ready, wait a bit then poll fast again
+                await asyncio.sleep(POLL_MAX_DELAY)
+                attempt = 0
+        
+        raise TimeoutError(f"Workflow execution timed out after {timeout} seconds")
+
+    @staticmethod
+    def check_result(result: Dict[str, Any]) -> Dict[str, Any]:
+        if result.get('status', {}).get('status_str') == 'error':
+            raise Exception(f"ComfyUI execution failed: {result['status']}")
+        return result
+
+async def process_image_to_video_async(
+    image_data: Union[str, bytes],  # base64 encoded image, or raw image bytes
+    prompt: str,
+    camera_type: str = "Zoom In",
+    width: int = 832,
+    height: int = 448,
+    length: int = 93,  # frames
+    speed: float = 0.2,  # camera speed (0.1-1.0)
+    fps: int = 30,  # video fps
+    client: Optional[AsyncComfyUIWorkflow] = None,  # shared client, one per request if None
+    **kwargs
+) -> Tuple[bytes, str]:
+    """Process image to video using ComfyUI workflow, without blocking the event loop"""
+    if client is None:
+        async with AsyncComfyUIWorkflow() as comfy:
+            return await process_image_to_video_async(
+                image_data, prompt, camera_type, width, height, length, speed, fps,
+                client=comfy, **kwargs
+            )
+    
+    image_bytes = decode_image(image_data)
+    temp_filename = temp_image_filename()
+    
+    # Upload image to ComfyUI
+    await stage_input_image(client, image_bytes, temp_filename)
+    logger.info(f"Uploaded image as: {temp_filename}")
+    
+    # Create workflow using the template, already encoded for /prompt
+    workflow = encode_wan_workflow(
+        image_filename=temp_filename,
+        prompt=prompt,
+        camera_type=camera_type,
+        width=width,
+        height=height,
+        length=length,
+        speed=speed,
+        fps=fps,
+        **kwargs
+    )
+    
+    # Queue and execute, holding a GPU slot until the prompt has finished
+    async with GPU_SLOTS:
+        prompt_id = await client.queue_prompt(workflow)
+        logger.info(f"Queued workflow with prompt_id: {prompt_id}")
+        
+        # Wait for completion
+        result = await client.wait_for_completion(prompt_id)
+    video_output = find_video_output(result)
+    
+    # Get video file
+    video_data = await client.get_image(
+        filename=video_output['filename'],
+        subfolder=video_output.get('subfolder', ''),
+        folder_type=video_output.get('type', 'output')
+    )
+    
+    return video_data, video_output['filename']
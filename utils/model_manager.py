@@ -1,14 +1,30 @@
 import os
+import re
+import hashlib
+import importlib.util
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
 import logging
 
+# Rust range-parallel downloads, must be set before huggingface_hub is imported
+if importlib.util.find_spec('hf_transfer') is not None:
+    os.environ.setdefault('HF_HUB_ENABLE_HF_TRANSFER', '1')
+
+try:
+    from huggingface_hub import hf_hub_download, hf_hub_url, get_hf_file_metadata
+except ImportError:
+    hf_hub_download = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Model URLs and file info
+# Model URLs and approximate sizes, exact sizes come from the source when needed
 MODELS_CONFIG = {
     "diffusion_models": {
         "wan2.2_fun_camera_high_noise_14B_fp8_scaled.safetensors": {
@@ -44,12 +60,203 @@ MODELS_CONFIG = {
     }
 }
 
+def parse_hf_url(url: str) -> Optional[Tuple[str, str, str]]:
+    """Split a huggingface.co resolve URL into (repo_id, revision, filename)"""
+    parsed = urlparse(url)
+    if parsed.netloc != 'huggingface.co':
+        return None
+    
+    parts = parsed.path.strip('/').split('/')
+    if len(parts) < 5 or parts[2] != 'resolve':
+        return None
+    
+    return f"{parts[0]}/{parts[1]}", parts[3], '/'.join(parts[4:])
+
+# Parsed once so downloads can go through the HuggingFace hub client
+HF_FILES = {
+    info['url']: parse_hf_url(info['url'])
+    for models in MODELS_CONFIG.values()
+    for info in models.values()
+}
+
+# Number of files downloaded concurrently
+MAX_PARALLEL_DOWNLOADS = int(os.environ.get('MAX_PARALLEL_DOWNLOADS', 4))
+
+# Configured sizes are rounded, offline a file without a checksum is only rejected
+# when it is clearly truncated
+OFFLINE_MIN_SIZE_FRACTION = 0.5
+
+# Never touch the network, fail if models are missing
+OFFLINE = os.environ.get('RUNPOD_OFFLINE') == '1'
+
+# Re-hash files against their .sha256 on every check (reads all model bytes)
+VERIFY_CHECKSUMS = os.environ.get('VERIFY_MODEL_CHECKSUMS') == '1'
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Model bytes are written once and mmap'd later by ComfyUI, keep them out of the page cache
+FADVISE = hasattr(os, 'posix_fadvise')
+DROP_CACHE_EVERY = 256 * 1024 * 1024
+
+def checksum_path(filepath: Path) -> Path:
+    """Path of the sha256sum-style checksum file next to a model"""
+    return filepath.with_name(filepath.name + '.sha256')
+
+def write_checksum(filepath: Path, digest: str) -> None:
+    """Record the checksum of a completed download"""
+    checksum_path(filepath).write_text(f"{digest}  {filepath.name}\n")
+
+def read_checksum(filepath: Path) -> Optional[str]:
+    """Read the recorded checksum of a model, if any"""
+    try:
+        return checksum_path(filepath).read_text().split()[0]
+    except (OSError, IndexError):
+        return None
+
+def sha256_file(filepath: Path) -> str:
+    """Hash a file on disk"""
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def drop_page_cache(filepath: Path) -> None:
+    """Flush a finished file and evict its pages from the page cache"""
+    if not FADVISE:
+        return
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        os.fsync(fd)  # Dirty pages can't be dropped
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def hf_file_info(hf_file: Tuple[str, str, str]) -> Tuple[Optional[int], Optional[str]]:
+    """Size and sha256 of a hub file, LFS etags are the file sha256"""
+    repo_id, revision, filename = hf_file
+    metadata = get_hf_file_metadata(hf_hub_url(repo_id, filename, revision=revision))
+    digest = (metadata.etag or '').lower()
+    return metadata.size, digest if SHA256_RE.match(digest) else None
+
+def remote_file_info(url: str) -> Tuple[Optional[int], Optional[str]]:
+    """Exact size and sha256 (when the server exposes it) of a remote file"""
+    hf_file = HF_FILES.get(url)
+    if hf_file and hf_hub_download is not None:
+        return hf_file_info(hf_file)
+    
+    response = get_session().head(url, allow_redirects=True, timeout=30)
+    response.raise_for_status()
+    length = response.headers.get('content-length')
+    return (int(length) if length else None), None
+
+def adopt_model(filepath: Path, info: Dict) -> bool:
+    """Accept a model downloaded without a checksum if it has the remote file's exact size"""
+    try:
+        remote_size, digest = remote_file_info(info['url'])
+    except Exception as e:
+        # Can't tell, keep the file rather than re-download it blind
+        logger.warning(f"Could not check {filepath.name} against its source: {e}")
+        return True
+    
+    if remote_size is None:
+        logger.warning(f"No size available for {filepath.name}, keeping it unchecked")
+        return True
+    if filepath.stat().st_size != remote_size:
+        return False
+    
+    # Checked once, later boots only need the sidecar
+    write_checksum(filepath, digest or sha256_file(filepath))
+    logger.info(f"Recorded checksum for existing {filepath.name}")
+    return True
+
+def is_valid_model(filepath: Path, info: Dict) -> bool:
+    """Check a model file is complete, from its checksum sidecar when it has one"""
+    try:
+        stat = filepath.stat()
+    except FileNotFoundError:
+        return False
+    
+    try:
+        checksum_stat = checksum_path(filepath).stat()
+    except FileNotFoundError:
+        checksum_stat = None
+    
+    if checksum_stat is not None:
+        # Written right after a finished download, later writes make the model newer
+        if checksum_stat.st_mtime < stat.st_mtime:
+            return False
+        if VERIFY_CHECKSUMS:
+            return sha256_file(filepath) == read_checksum(filepath)
+        return True
+    
+    if OFFLINE:
+        return stat.st_size >= info['size'] * OFFLINE_MIN_SIZE_FRACTION
+    return adopt_model(filepath, info)
+
+# One HTTP session per download worker thread
+_thread_local = threading.local()
+
+def get_session() -> requests.Session:
+    """Get the HTTP session for the current thread"""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _thread_local.session = session
+    return session
+
+def download_hf_file(hf_file: Tuple[str, str, str], filepath: Path) -> bool:
+    """Download a file from the HuggingFace hub (resumable, hf_transfer if installed)"""
+    repo_id, revision, filename = hf_file
+    
+    # Hub keeps the repo layout under local_dir, so stage it next to the target
+    staging_dir = filepath.parent / '.hf_download'
+    
+    # The hub's sha256 for the sidecar, a lookup failure only means hashing the file later
+    try:
+        _, digest = hf_file_info(hf_file)
+    except Exception as e:
+        logger.warning(f"No hub checksum for {filepath.name}, will hash it: {e}")
+        digest = None
+    
+    try:
+        logger.info(f"Downloading {filepath.name} from {repo_id}...")
+        
+        downloaded_path = hf_hub_download(
+            repo_id=repo_id,
+            filename=filename,
+            revision=revision,
+            local_dir=staging_dir
+        )
+        os.replace(downloaded_path, filepath)
+        drop_page_cache(filepath)
+        
+        write_checksum(filepath, digest or sha256_file(filepath))
+        
+        logger.info(f"✓ Downloaded {filepath.name}")
+        return True
+        
+    except Exception as e:
+        # Partial data stays in the staging dir so the next attempt resumes
+        logger.error(f"Failed to download {filepath.name}: {e}")
+        return False
+
 def download_file(url: str, filepath: Path, expected_size: int = None) -> bool:
     """Download a file with progress tracking"""
+    # Drop the old checksum so an interrupted download never looks valid
+    checksum_path(filepath).unlink(missing_ok=True)
+    
+    hf_file = HF_FILES.get(url)
+    if hf_file and hf_hub_download is not None:
+        return download_hf_file(hf_file, filepath)
+    
     try:
         logger.info(f"Downloading {filepath.name}...")
         
-        response = requests.get(url, stream=True)
+        response = get_session().get(url, stream=True)
         response.raise_for_status()
         
         # Get total size from headers
@@ -58,18 +265,31 @@ def download_file(url: str, filepath: Path, expected_size: int = None) -> bool:
             logger.warning(f"Size mismatch: expected {expected_size}, got {total_size}")
         
         downloaded = 0
-        chunk_size = 8192 * 16  # 128KB chunks
+        chunk_size = 4 * 1024 * 1024  # 4MB chunks
+        sha256 = hashlib.sha256()
         
         with open(filepath, 'wb') as f:
+            if FADVISE:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            
             for chunk in response.iter_content(chunk_size=chunk_size):
                 if chunk:
                     f.write(chunk)
+                    sha256.update(chunk)
                     downloaded += len(chunk)
                     
+                    # Evict what has likely been written back already, dirty pages are skipped
+                    # (not at the first boundary, where a zero length would mean the whole file)
+                    if FADVISE and downloaded > DROP_CACHE_EVERY and downloaded % DROP_CACHE_EVERY == 0:
+                        os.posix_fadvise(f.fileno(), 0, downloaded - DROP_CACHE_EVERY, os.POSIX_FADV_DONTNEED)
+                    
                     # Log progress every ~100MB
                     if downloaded % (100 * 1024 * 1024) == 0:
                         progress = (downloaded / total_size * 100) if total_size > 0 else 0
-                        logger.info(f"  Progress: {downloaded / (1024*1024*1024):.1f}GB ({progress:.1f}%)")
+                        logger.info(f"  {filepath.name}: {downloaded / (1024*1024*1024):.1f}GB ({progress:.1f}%)")
+        
+        drop_page_cache(filepath)
+        write_checksum(filepath, sha256.hexdigest())
         
         logger.info(f"✓ Downloaded {filepath.name}")
         return True
@@ -99,10 +319,10 @@ def check_and_download_models() -> None:
         for filename, info in models.items():
             filepath = category_path / filename
             
-            if not filepath.exists():
+            if not is_valid_model(filepath, info):
                 missing_models.append((category, filename, info))
                 total_missing_size += info['size']
-                logger.info(f"Missing: {category}/{filename}")
+                logger.info(f"Missing or incomplete: {category}/{filename}")
             else:
                 logger.info(f"Found: {category}/{filename}")
     
@@ -110,18 +330,34 @@ def check_and_download_models() -> None:
         logger.info("All models present!")
         return
     
+    if OFFLINE:
+        names = ', '.join(filename for _, filename, _ in missing_models)
+        raise Exception(f"RUNPOD_OFFLINE=1 but models are missing or incomplete: {names}")
+    
+    # Largest first (diffusion models), so they land early and the pool finishes together
+    missing_models.sort(key=lambda model: model[2]['size'], reverse=True)
+    
     # Log total download size
     total_gb = total_missing_size / (1024 * 1024 * 1024)
     logger.info(f"Need to download {len(missing_models)} files ({total_gb:.1f} GB total)")
     
-    # Download missing models
-    for category, filename, info in missing_models:
-        category_path = models_base / category
-        filepath = category_path / filename
+    # Download missing models in parallel
+    workers = max(1, min(MAX_PARALLEL_DOWNLOADS, len(missing_models)))
+    logger.info(f"Downloading with {workers} parallel workers")
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for category, filename, info in missing_models:
+            filepath = models_base / category / filename
+            future = executor.submit(download_file, info['url'], filepath, info['size'])
+            futures[future] = filename
         
-        success = download_file(info['url'], filepath, info['size'])
-        if not success:
-            raise Exception(f"Failed to download required model: {filename}")
+        for future in as_completed(futures):
+            if not future.result():
+                # Drop queued downloads, running ones finish on exit
+                for pending in futures:
+                    pending.cancel()
+                raise Exception(f"Failed to download required model: {futures[future]}")
     
     logger.info("All models downloaded successfully!")
 
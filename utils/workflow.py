@@ -1,60 +1,315 @@
 import json
+import os
+import sys
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import websocket
 import threading
 import time
-from typing import Dict, Any, Optional, Tuple
+import random
+from types import MappingProxyType
+from collections import OrderedDict
+from typing import Dict, Any, Mapping, Optional, Tuple, Union, BinaryIO
 import logging
 from pathlib import Path
-import base64
 from io import BytesIO
-from PIL import Image
+
+try:
+    import pybase64 as base64  # SIMD base64, same API as the stdlib module
+except ImportError:
+    import base64
+
+try:
+    import orjson  # Rust JSON codec, encodes straight to bytes
+    
+    def json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+    
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+    
+    json_loads = json.loads
+
+try:
+    from requests_toolbelt.multipart.encoder import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
 
 logger = logging.getLogger(__name__)
 
+# Polling fallback delays: start fast for short jobs, back off for long ones
+POLL_INITIAL_DELAY = 0.2
+POLL_BACKOFF = 1.5
+POLL_MAX_DELAY = 2.0
+POLL_JITTER = 0.05
+
+def poll_delay(attempt: int) -> float:
+    """Exponential backoff with a little jitter so clients don't poll in lockstep"""
+    return min(POLL_MAX_DELAY, POLL_INITIAL_DELAY * (POLL_BACKOFF ** attempt)) + random.random() * POLL_JITTER
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# ComfyUI's input directory when it is on this filesystem, lets images skip the HTTP upload
+COMFY_INPUT_DIR = os.environ.get('COMFY_INPUT_DIR')
+
+# Prompts the sync path lets ComfyUI hold at once, more would only contend for VRAM
+# (the async client has its own semaphore with the same limit)
+MAX_CONCURRENT_JOBS = int(os.environ.get('MAX_CONCURRENT_JOBS', 1))
+GPU_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_JOBS)
+
+def encode_prompt(workflow: Union[Dict[str, Any], bytes], client_id: str) -> bytes:
+    """/prompt request body, a pre-encoded workflow is spliced in as is"""
+    if isinstance(workflow, bytes):
+        return b'{"prompt":' + workflow + b',"client_id":' + json_dumps(client_id) + b'}'
+    return json_dumps({"prompt": workflow, "client_id": client_id})
+
+def prompt_in_queue(queue: Dict[str, Any], prompt_id: str) -> bool:
+    """Whether a /queue response still lists the prompt as running or pending"""
+    return any(
+        item[1] == prompt_id
+        for key in ("queue_running", "queue_pending")
+        for item in queue.get(key, [])
+    )
+
+class PromptWaiter:
+    """Completion signal for one queued prompt"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.error: Optional[str] = None
+        self.disconnected = False
+
+    def finish(self, error: Optional[str] = None, disconnected: bool = False):
+        self.error = error
+        self.disconnected = disconnected
+        self.event.set()
+
+class ComfyUIEvents:
+    """One WebSocket per process, completion messages dispatched to waiting prompts"""
+    
+    # Results kept for prompts that finish before anyone waits on them
+    MAX_UNCLAIMED = 256
+    
+    # Ping after this long without frames, give up if nothing answers for as long again
+    IDLE_TIMEOUT = 30
+    
+    def __init__(self, server_address: str):
+        self.server_address = server_address
+        self.client_id = str(uuid.uuid4())
+        self.lock = threading.Lock()
+        self.pending: Dict[str, PromptWaiter] = {}
+        self.unclaimed: OrderedDict = OrderedDict()
+        self.ws: Optional[websocket.WebSocket] = None
+        
+    @property
+    def connected(self) -> bool:
+        return self.ws is not None
+
+    def connect(self) -> bool:
+        """Open the ComfyUI push channel and start dispatching, False if unavailable"""
+        with self.lock:
+            if self.ws is not None:
+                return True
+            try:
+                ws = websocket.WebSocket()
+                ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}", timeout=10)
+                ws.settimeout(self.IDLE_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"WebSocket unavailable, falling back to polling: {e}")
+                return False
+            self.ws = ws
+        
+        threading.Thread(target=self.run, args=(ws,), name="comfyui-events", daemon=True).start()
+        return True
+
+    def register(self, prompt_id: str) -> PromptWaiter:
+        """Get the waiter for a prompt, already finished if its result came in first"""
+        waiter = PromptWaiter()
+        with self.lock:
+            if prompt_id in self.unclaimed:
+                waiter.finish(self.unclaimed.pop(prompt_id))
+            elif self.ws is None:
+                waiter.finish(disconnected=True)
+            else:
+                self.pending[prompt_id] = waiter
+        return waiter
+
+    def unregister(self, prompt_id: str):
+        with self.lock:
+            self.pending.pop(prompt_id, None)
+
+    def complete(self, prompt_id: str, error: Optional[str] = None):
+        with self.lock:
+            waiter = self.pending.pop(prompt_id, None)
+            if waiter is None:
+                if prompt_id not in self.unclaimed:
+                    self.unclaimed[prompt_id] = error
+                    if len(self.unclaimed) > self.MAX_UNCLAIMED:
+                        self.unclaimed.popitem(last=False)
+                return
+        waiter.finish(error)
+
+    def run(self, ws: websocket.WebSocket):
+        """Receive loop, ends when the socket fails or stops answering"""
+        pinged = False
+        try:
+            while True:
+                try:
+                    opcode, message = ws.recv_data(control_frame=True)
+                except websocket.WebSocketTimeoutException:
+                    # A write to a half-open socket succeeds, only a reply proves it alive
+                    if pinged:
+                        raise ConnectionError(f"no frames for {2 * self.IDLE_TIMEOUT}s")
+                    ws.ping()
+                    pinged = True
+                    continue
+                pinged = False
+                if opcode != websocket.ABNF.OPCODE_TEXT:
+                    continue  # Pongs, pings and binary preview frames
+                
+                message = json_loads(message)
+                data = message.get('data', {})
+                prompt_id = data.get('prompt_id')
+                if prompt_id is None:
+                    continue
+                
+                message_type = message.get('type')
+                # Sent after the prompt is written to /history, execution_success comes before that
+                if message_type == 'executing' and data.get('node') is None:
+                    self.complete(prompt_id)
+                elif message_type == 'execution_error':
+                    self.complete(prompt_id, str(data.get('exception_message', data)))
+                elif message_type == 'execution_interrupted':
+                    self.complete(prompt_id, "execution interrupted")
+        except Exception as e:
+            logger.warning(f"ComfyUI WebSocket closed: {e}")
+        
+        # Waiters fall back to polling, the next client reconnects
+        with self.lock:
+            self.ws = None
+            waiters = list(self.pending.values())
+            self.pending.clear()
+        for waiter in waiters:
+            waiter.finish(disconnected=True)
+        try:
+            ws.close()
+        except Exception:
+            pass
+
+_events: Dict[str, ComfyUIEvents] = {}
+_events_lock = threading.Lock()
+
+def get_events(server_address: str) -> ComfyUIEvents:
+    """Shared event listener for a ComfyUI server"""
+    with _events_lock:
+        events = _events.get(server_address)
+        if events is None:
+            events = _events[server_address] = ComfyUIEvents(server_address)
+    return events
+
 class ComfyUIWorkflow:
+    # Set once a warmup prompt has run in this process
+    _warmed = False
+    
     def __init__(self, server_address="127.0.0.1:8188"):
         self.server_address = server_address
-        self.client_id = str(uuid.uuid4())
         
-    def queue_prompt(self, workflow: Dict[str, Any]) -> str:
-        """Queue a prompt and return the prompt ID"""
+        self.base_url = f"http://{server_address}"
+        
+        # Keep-alive connections reused across uploads, polls and downloads
+        # Connection errors are retried for any method, 5xx only for idempotent ones
+        retries = Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retries))
+        
+        # ComfyUI only pushes execution messages to the socket of the queuing client_id
+        self.events = get_events(server_address)
+        if self.events.connect():
+            self.client_id = self.events.client_id
+        else:
+            self.client_id = str(uuid.uuid4())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the HTTP session (the WebSocket is shared)"""
+        self.session.close()
+        
+    def queue_prompt(self, workflow: Union[Dict[str, Any], bytes]) -> str:
+        """Queue a prompt (a workflow dict, or its JSON encoding) and return the prompt ID"""
         try:
-            prompt = {"prompt": workflow, "client_id": self.client_id}
-            data = json.dumps(prompt).encode('utf-8')
+            data = encode_prompt(workflow, self.client_id)
             
-            response = requests.post(f"http://{self.server_address}/prompt", data=data)
+            response = self.session.post(f"{self.base_url}/prompt", data=data)
             response.raise_for_status()
             
-            result = response.json()
+            result = json_loads(response.content)
             return result['prompt_id']
             
         except Exception as e:
             logger.error(f"Failed to queue prompt: {e}")
             raise
 
-    def upload_image(self, image_data: bytes, filename: str) -> bool:
-        """Upload image to ComfyUI input directory"""
+    def upload_image(self, image_data: Union[bytes, BinaryIO], filename: str) -> bool:
+        """Upload image (bytes or file-like) to ComfyUI input directory"""
         try:
-            files = {'image': (filename, image_data, 'image/png')}
-            response = requests.post(f"http://{self.server_address}/upload/image", files=files)
+            url = f"{self.base_url}/upload/image"
+            fields = {'image': (filename, image_data, 'image/png')}
+            
+            if MultipartEncoder is not None:
+                # Body is streamed from image_data instead of assembled in memory
+                encoder = MultipartEncoder(fields=fields)
+                response = self.session.post(url, data=encoder, headers={'Content-Type': encoder.content_type})
+            else:
+                # Without requests_toolbelt the whole multipart body is built in memory
+                response = self.session.post(url, files=fields)
             response.raise_for_status()
             return True
         except Exception as e:
             logger.error(f"Failed to upload image: {e}")
             raise
 
-    def get_image(self, filename: str, subfolder: str = "", folder_type: str = "output") -> bytes:
+    def stage_image(self, image_bytes: bytes, filename: str) -> None:
+        """Upload an input image, or write it straight into ComfyUI's input directory"""
+        if COMFY_INPUT_DIR:
+            write_input_image(image_bytes, filename)
+        else:
+            self.upload_image(BytesIO(image_bytes), filename)
+
+    def get_image(self, filename: str, subfolder: str = "", folder_type: str = "output") -> Union[bytes, bytearray]:
         """Get generated image from ComfyUI"""
         try:
             data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-            url = f"http://{self.server_address}/view"
-            
-            response = requests.get(url, params=data)
-            response.raise_for_status()
+            url = f"{self.base_url}/view"
             
-            return response.content
+            with self.session.get(url, params=data, stream=True) as response:
+                response.raise_for_status()
+                
+                # Fill one buffer of the final size instead of joining chunks (urllib3 still
+                # reads each step into a temporary bytes before copying it in)
+                length = response.headers.get('Content-Length')
+                if length is not None and not response.headers.get('Content-Encoding'):
+                    buf = bytearray(int(length))
+                    view = memoryview(buf)
+                    offset = 0
+                    while offset < len(buf):
+                        read = response.raw.readinto(view[offset:offset + DOWNLOAD_CHUNK_SIZE])
+                        if not read:
+                            raise IOError(f"Connection closed after {offset} of {len(buf)} bytes")
+                        offset += read
+                    return buf
+                
+                buf = bytearray()
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    buf += chunk
+                return buf
             
         except Exception as e:
             logger.error(f"Failed to get image: {e}")
@@ -63,20 +318,58 @@ class ComfyUIWorkflow:
     def get_history(self, prompt_id: str) -> Dict[str, Any]:
         """Get execution history for a prompt"""
         try:
-            response = requests.get(f"http://{self.server_address}/history/{prompt_id}")
+            response = self.session.get(f"{self.base_url}/history/{prompt_id}")
             response.raise_for_status()
-            return response.json()
+            return json_loads(response.content)
         except Exception as e:
             logger.error(f"Failed to get history: {e}")
             raise
 
+    def get_queue(self) -> Dict[str, Any]:
+        """Get the running and pending prompts"""
+        try:
+            response = self.session.get(f"{self.base_url}/queue")
+            response.raise_for_status()
+            return json_loads(response.content)
+        except Exception as e:
+            logger.error(f"Failed to get queue: {e}")
+            raise
+
     def wait_for_completion(self, prompt_id: str, timeout: int = 600) -> Dict[str, Any]:
         """Wait for prompt completion and return results"""
         start_time = time.time()
         
+        if self.client_id == self.events.client_id:
+            waiter = self.events.register(prompt_id)
+            if not waiter.event.wait(timeout):
+                self.events.unregister(prompt_id)
+                raise TimeoutError(f"Workflow execution timed out after {timeout} seconds")
+            
+            if waiter.error is not None:
+                raise Exception(f"ComfyUI execution failed: {waiter.error}")
+            
+            if not waiter.disconnected:
+                history = self.get_history(prompt_id)
+                if prompt_id in history:
+                    result = history[prompt_id]
+                    if result.get('status', {}).get('status_str') == 'error':
+                        raise Exception(f"ComfyUI execution failed: {result['status']}")
+                    return result
+            else:
+                logger.warning("WebSocket failed, falling back to polling")
+        
+        return self.poll_for_completion(prompt_id, start_time, timeout)
+
+    def poll_for_completion(self, prompt_id: str, start_time: float, timeout: int) -> Dict[str, Any]:
+        """Poll /queue with a growing delay, /history once the prompt has left it"""
+        attempt = 0
+        
         while time.time() - start_time < timeout:
             try:
-                history = self.get_history(prompt_id)
+                # History is written before the prompt leaves the queue
+                history = {}
+                if not prompt_in_queue(self.get_queue(), prompt_id):
+                    history = self.get_history(prompt_id)
                 
                 if prompt_id in history:
                     result = history[prompt_id]
@@ -89,27 +382,87 @@ class ComfyUIWorkflow:
                     if result.get('status', {}).get('status_str') == 'error':
                         raise Exception(f"ComfyUI execution failed: {result['status']}")
                 
-                time.sleep(2)  # Check every 2 seconds
+                time.sleep(poll_delay(attempt))
+                attempt += 1
                 
             except requests.exceptions.RequestException:
-                # ComfyUI might not be fully ready, wait a bit
-                time.sleep(5)
+                # ComfyUI might not be fully ready, wait a bit then poll fast again
+                time.sleep(POLL_MAX_DELAY)
+                attempt = 0
                 
         raise TimeoutError(f"Workflow execution timed out after {timeout} seconds")
 
+    def warmup(self, timeout: int = 900) -> None:
+        """Run a tiny prompt once so both diffusion models, VAE and text encoder are loaded"""
+        if ComfyUIWorkflow._warmed:
+            return
+        
+        start_time = time.time()
+        filename = temp_image_filename()
+        self.stage_image(blank_png(WARMUP_SIZE, WARMUP_SIZE), filename)
+        
+        prompt_id = self.queue_prompt(create_warmup_workflow(filename))
+        self.wait_for_completion(prompt_id, timeout)
+        
+        ComfyUIWorkflow._warmed = True
+        logger.info(f"ComfyUI warmed up in {time.time() - start_time:.1f}s")
+
 # Load the API workflow template from JSON file
 def load_workflow_template():
     """Load the workflow template from the API JSON export"""
-    import os
     workflow_path = os.path.join(os.path.dirname(__file__), '..', 'serverlessAPI_wan2_2_14B_camera.json')
     try:
-        with open(workflow_path, 'r') as f:
-            return json.load(f)
+        with open(workflow_path, 'rb') as f:
+            return json_loads(f.read())
     except FileNotFoundError:
         logger.error(f"Workflow template not found at {workflow_path}")
         raise
 
-WORKFLOW_TEMPLATE = load_workflow_template()
+# Short strings (keys, class types, sampler names) are interned, prompts are left alone
+INTERN_MAX_LEN = 64
+
+def intern_strings(obj: Any) -> Any:
+    """Intern dict keys and short string values so lookups hit on identity"""
+    if isinstance(obj, dict):
+        return {sys.intern(key): intern_strings(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [intern_strings(value) for value in obj]
+    if isinstance(obj, str) and len(obj) <= INTERN_MAX_LEN:
+        return sys.intern(obj)
+    return obj
+
+# Read-only at the top level, nodes stay plain dicts so they can be shared and serialized
+WORKFLOW_TEMPLATE: Mapping[str, Any] = MappingProxyType(intern_strings(load_workflow_template()))
+
+# Nodes set per request (LoadImage, positive prompt, camera embedding) and the SaveVideo output
+DYNAMIC_NODES = ("79", "81", "87")
+VIDEO_OUTPUT_NODE = "73"
+
+# Node types and inputs this module relies on, keyed by node id
+TEMPLATE_SCHEMA = {
+    "79": ("LoadImage", ("image",)),
+    "81": ("CLIPTextEncode", ("text",)),
+    "87": ("WanCameraEmbedding", ("camera_pose", "width", "height", "length")),
+    "71": ("KSamplerAdvanced", ("add_noise", "steps", "start_at_step", "end_at_step")),
+    "78": ("KSamplerAdvanced", ("steps", "start_at_step", "end_at_step")),
+    VIDEO_OUTPUT_NODE: ("SaveVideo", ()),
+}
+
+def validate_template(workflow: Mapping[str, Any]) -> None:
+    """Fail at import if a re-exported template no longer matches the node ids we patch"""
+    for node_id, (class_type, inputs) in TEMPLATE_SCHEMA.items():
+        node = workflow.get(node_id)
+        if node is None or node.get("class_type") != class_type:
+            raise ValueError(f"Workflow template node {node_id} must be a {class_type}")
+        missing = [name for name in inputs if name not in node.get("inputs", {})]
+        if missing:
+            raise ValueError(f"Workflow template node {node_id} is missing inputs: {missing}")
+
+validate_template(WORKFLOW_TEMPLATE)
+
+def with_inputs(node: Dict[str, Any], **inputs) -> Dict[str, Any]:
+    """Copy of a template node with some inputs replaced"""
+    return {**node, "inputs": {**node["inputs"], **inputs}}
 
 def create_wan_workflow(
     image_filename: str,  # Image filename (será subida a ComfyUI)
@@ -120,84 +473,171 @@ def create_wan_workflow(
     length: int = 93,
     **kwargs
 ) -> Dict[str, Any]:
-    """Create workflow by modifying the template with user parameters"""
-    import copy
-    
-    # Deep copy the template to avoid modifying the original
-    workflow = copy.deepcopy(WORKFLOW_TEMPLATE)
-    
-    # Update dynamic parameters
-    workflow["79"]["inputs"]["image"] = image_filename  # LoadImage
-    workflow["81"]["inputs"]["text"] = prompt  # Positive prompt
-    workflow["87"]["inputs"]["camera_pose"] = camera_type  # Camera type
-    workflow["87"]["inputs"]["width"] = width
-    workflow["87"]["inputs"]["height"] = height  
-    workflow["87"]["inputs"]["length"] = length
+    """Create workflow by modifying the template with user parameters
     
+    Only the dynamic nodes are new objects, the rest are shared with
+    WORKFLOW_TEMPLATE and must not be modified by callers.
+    """
+    # Share untouched nodes with the template, rebuild only the ones we modify
+    workflow = dict(WORKFLOW_TEMPLATE)
+    workflow.update(wan_dynamic_nodes(image_filename, prompt, camera_type, width, height, length))
     return workflow
 
-def process_image_to_video(
-    image_data: str,  # base64 encoded image
-    prompt: str, 
+def wan_dynamic_nodes(
+    image_filename: str,
+    prompt: str,
+    camera_type: str,
+    width: int,
+    height: int,
+    length: int
+) -> Dict[str, Any]:
+    """The DYNAMIC_NODES of a request, keyed by node id"""
+    return {
+        "79": with_inputs(WORKFLOW_TEMPLATE["79"], image=image_filename),  # LoadImage
+        "81": with_inputs(WORKFLOW_TEMPLATE["81"], text=prompt),  # Positive prompt
+        "87": with_inputs(  # Camera embedding
+            WORKFLOW_TEMPLATE["87"],
+            camera_pose=camera_type,
+            width=width,
+            height=height,
+            length=length
+        ),
+    }
+
+# Every other node is the same for all requests, so it is encoded once
+STATIC_WORKFLOW_JSON = json_dumps({
+    node_id: node for node_id, node in WORKFLOW_TEMPLATE.items()
+    if node_id not in DYNAMIC_NODES
+})
+
+def encode_wan_workflow(
+    image_filename: str,
+    prompt: str,
     camera_type: str = "Zoom In",
     width: int = 832,
     height: int = 448,
-    length: int = 93,  # frames
-    speed: float = 0.2,  # camera speed (0.1-1.0) 
-    fps: int = 30,  # video fps
+    length: int = 93,
     **kwargs
-) -> Tuple[bytes, str]:
-    """Process image to video using ComfyUI workflow"""
-    
-    comfy = ComfyUIWorkflow()
+) -> bytes:
+    """JSON of create_wan_workflow, encoding only the dynamic nodes per call"""
+    dynamic = json_dumps(wan_dynamic_nodes(image_filename, prompt, camera_type, width, height, length))
     
-    # Convert base64 to bytes and upload to ComfyUI
-    import base64
-    import uuid
-    
-    image_bytes = base64.b64decode(image_data)
-    temp_filename = f"input_{uuid.uuid4().hex[:8]}.png"
-    
-    # Upload image to ComfyUI
-    comfy.upload_image(image_bytes, temp_filename)
-    logger.info(f"Uploaded image as: {temp_filename}")
-    
-    # Create workflow using the template
+    # Join the two objects: drop the static one's closing brace and the dynamic one's opening brace
+    return STATIC_WORKFLOW_JSON[:-1] + b',' + dynamic[1:]
+
+# Smallest graph that still runs every model once
+WARMUP_SIZE = 64
+
+def create_warmup_workflow(image_filename: str) -> Dict[str, Any]:
+    """One step on each of the high and low noise samplers, one 64x64 frame"""
     workflow = create_wan_workflow(
-        image_filename=temp_filename,
-        prompt=prompt,
-        camera_type=camera_type,
-        width=width,
-        height=height,
-        length=length,
-        speed=speed,
-        fps=fps,
-        **kwargs
+        image_filename=image_filename,
+        prompt="warmup",
+        width=WARMUP_SIZE,
+        height=WARMUP_SIZE,
+        length=1
     )
     
-    # Queue and execute
-    prompt_id = comfy.queue_prompt(workflow)
-    logger.info(f"Queued workflow with prompt_id: {prompt_id}")
+    # A single step would leave the low noise sampler (78) with nothing to do, so split two
+    workflow["71"] = with_inputs(WORKFLOW_TEMPLATE["71"], add_noise="disable", steps=2, start_at_step=0, end_at_step=1)
+    workflow["78"] = with_inputs(WORKFLOW_TEMPLATE["78"], steps=2, start_at_step=1, end_at_step=2)
     
-    # Wait for completion
-    result = comfy.wait_for_completion(prompt_id)
+    return workflow
+
+def blank_png(width: int, height: int) -> bytes:
+    """Black RGB PNG used as the warmup input image"""
+    from PIL import Image
     
-    # Extract video file from results
+    buf = BytesIO()
+    Image.new("RGB", (width, height)).save(buf, format="PNG")
+    return buf.getvalue()
+
+def find_video_output(result: Dict[str, Any], node_id: str = VIDEO_OUTPUT_NODE) -> Dict[str, Any]:
+    """Get the SaveVideo file entry from a finished prompt's history"""
     outputs = result.get('outputs', {})
     
     # Find the SaveVideo node output (node 73 in our workflow)
     video_output = None
-    if '73' in outputs and 'videos' in outputs['73']:
-        video_output = outputs['73']['videos'][0]
+    if node_id in outputs and 'videos' in outputs[node_id]:
+        video_output = outputs[node_id]['videos'][0]
     
     if not video_output:
         raise Exception("No video output found in workflow result")
     
-    # Get video file
-    video_data = comfy.get_image(
-        filename=video_output['filename'],
-        subfolder=video_output.get('subfolder', ''),
-        folder_type=video_output.get('type', 'output')
-    )
+    return video_output
+
+def temp_image_filename() -> str:
+    """Unique name for an uploaded input image (72 random bits)"""
+    return f"input_{base64.urlsafe_b64encode(os.urandom(9)).decode('ascii')}.png"
+
+def write_input_image(image_bytes: bytes, filename: str) -> Path:
+    """Place an image in ComfyUI's input directory, atomically so LoadImage never sees a partial file"""
+    input_dir = Path(COMFY_INPUT_DIR)
+    input_dir.mkdir(parents=True, exist_ok=True)
+    
+    path = input_dir / filename
+    tmp_path = input_dir / f".{filename}.tmp"
+    tmp_path.write_bytes(image_bytes)
+    os.replace(tmp_path, path)
+    return path
+
+def decode_image(image_data: Union[str, bytes]) -> bytes:
+    """Image file bytes from a base64 string, raw bytes are passed through"""
+    if isinstance(image_data, str):
+        return base64.b64decode(image_data, validate=False)
+    return image_data
+
+def process_image_to_video(
+    image_data: Union[str, bytes],  # base64 encoded image, or raw image bytes
+    prompt: str, 
+    camera_type: str = "Zoom In",
+    width: int = 832,
+    height: int = 448,
+    length: int = 93,  # frames
+    speed: float = 0.2,  # camera speed (0.1-1.0) 
+    fps: int = 30,  # video fps
+    **kwargs
+) -> Tuple[Union[bytes, bytearray], str]:
+    """Process image to video using ComfyUI workflow"""
     
-    return video_data, video_output['filename']
\ No newline at end of file
+    with ComfyUIWorkflow() as comfy:
+        # Convert base64 to bytes and upload to ComfyUI
+        image_bytes = decode_image(image_data)
+        temp_filename = temp_image_filename()
+        
+        # Upload image to ComfyUI, or write it straight into its input directory
+        comfy.stage_image(image_bytes, temp_filename)
+        logger.info(f"Uploaded image as: {temp_filename}")
+        
+        # Create workflow using the template, already encoded for /prompt
+        workflow = encode_wan_workflow(
+            image_filename=temp_filename,
+            prompt=prompt,
+            camera_type=camera_type,
+            width=width,
+            height=height,
+            length=length,
+            speed=speed,
+            fps=fps,
+            **kwargs
+        )
+        
+        # Queue and execute, holding a GPU slot until the prompt has finished
+        with GPU_SLOTS:
+            prompt_id = comfy.queue_prompt(workflow)
+            logger.info(f"Queued workflow with prompt_id: {prompt_id}")
+            
+            # Wait for completion
+            result = comfy.wait_for_completion(prompt_id)
+        
+        # Extract video file from results
+        video_output = find_video_output(result)
+        
+        # Get video file
+        video_data = comfy.get_image(
+            filename=video_output['filename'],
+            subfolder=video_output.get('subfolder', ''),
+            folder_type=video_output.get('type', 'output')
+        )
+        
+        return video_data, video_output['filename']
\ No newline at end of file